@@ -5,19 +5,32 @@
 
 import argparse
 import asyncio
+import bisect
+import gc
 import logging
+import re
+import time
+import zlib
 from enum import Enum
 from functools import partial
-from html.parser import HTMLParser
 from pathlib import Path
-from string import Template
-from typing import List, Tuple, Dict, Optional, Iterable
+from typing import (
+    AbstractSet,
+    Callable,
+    List,
+    Tuple,
+    Dict,
+    Optional,
+    Iterable,
+    Set,
+)
 
 import aiometer
 import httpx
-import pydantic
+import msgspec
 import rich.progress as rprog
 import tenacity
+import uvloop
 from rich.logging import RichHandler
 
 
@@ -36,7 +49,9 @@ class RepositoryState(str, Enum):
     NORMAL = "NORMAL"
 
 
-class Repository(pydantic.BaseModel):
+# The many response and cache structs never form reference cycles, so they are
+# excluded from garbage collection with `gc=False`.
+class Repository(msgspec.Struct, gc=False):
     """Define the repository data of interest."""
 
     namespace: str
@@ -44,49 +59,138 @@ class Repository(pydantic.BaseModel):
     is_public: bool
     kind: RepositoryKind
     state: RepositoryState
+    last_modified: Optional[int] = None
 
 
-class RepositoryListResponse(pydantic.BaseModel):
+class RepositoryListResponse(msgspec.Struct, gc=False):
     """Define the repository list data of interest."""
 
     repositories: List[Repository]
     next_page: Optional[str] = None
 
 
-class RepositoryTag(pydantic.BaseModel):
-    """Define the repository tag data of interest."""
+class SingleRepositoryResponse(msgspec.Struct, gc=False):
+    """Define the single repository data of interest."""
 
-    name: str
+    # The repository fields are validated by the repository list already and the
+    # name is reused from there. Only the tag names are used, so the tag details are
+    # left undecoded.
+    tags: Dict[str, msgspec.Raw]
 
 
-class SingleRepositoryResponse(Repository):
-    """Define the single repository data of interest."""
+# Decoders are created once so that their schema is reused for every response.
+REPOSITORY_LIST_DECODER = msgspec.json.Decoder(RepositoryListResponse)
+SINGLE_REPOSITORY_DECODER = msgspec.json.Decoder(SingleRepositoryResponse)
+
+
+class CachedRepository(msgspec.Struct, gc=False):
+    """Define the cached tags of a single repository."""
+
+    name: str
+    tags: List[str]
+    # The time of the latest tag change as reported by the repository list.
+    timestamp: Optional[int] = None
+    # The time the tags were last confirmed by quay.io.
+    fetched_at: Optional[float] = None
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
 
-    tags: Dict[str, RepositoryTag]
+class RepositoryCache(msgspec.Struct):
+    """Define the on-disk cache of repository tags kept between runs."""
 
+    repositories: Dict[str, CachedRepository] = msgspec.field(default_factory=dict)
 
-class ContainerImageParser(HTMLParser):
-    """Define a parser for container names and tags."""
+    @classmethod
+    def load(cls, filename: Path) -> "RepositoryCache":
+        """Load a cache from the given file; start empty if it is missing or invalid."""
+        if not filename.is_file():
+            return cls()
+        try:
+            return msgspec.json.decode(filename.read_bytes(), type=cls)
+        except msgspec.DecodeError:
+            logger.warning("Ignoring invalid repository cache '%s'.", filename)
+            return cls()
+
+    def dump(self, filename: Path) -> None:
+        """Write the cache to the given file."""
+        filename.write_bytes(msgspec.json.encode(self))
+
+
+class ContainerImageParser:
+    """
+    Define a parser for container names and tags.
+
+    Depot index pages are plain listings of links, so rather than building an HTML
+    tree, anchors whose target contains an encoded colon are extracted with a
+    compiled regular expression directly from the raw response bytes. The document
+    may be fed in chunks as it is being downloaded.
+
+    """
+
+    # Tag and attribute names are matched in any case and values in either quotes,
+    # like `HTMLParser` does, but the encoded colon only in upper case, as before.
+    _HREF_PATTERN = re.compile(
+        rb"""<a\s[^>]*?href\s*=\s*"""
+        rb"""(?:"([^"]*(?-i:%3A)[^"]*)"|'([^']*(?-i:%3A)[^']*)')""",
+        re.IGNORECASE,
+    )
 
-    def __init__(self, **kwargs) -> None:
+    def __init__(self) -> None:
         """Initialize a default container parser."""
-        super().__init__(**kwargs)
         self._images = []
+        self._tail = b""
+
+    def drain(self) -> List[str]:
+        """Return the container images parsed so far and hand over their ownership."""
+        images, self._images = self._images, []
+        return images
+
+    def feed(self, data: bytes) -> None:
+        """Parse container images from the next chunk of an HTML document."""
+        data = self._tail + data
+        # The last tag may be cut off by the end of the chunk, so it is only parsed
+        # together with the next chunk.
+        end = data.rfind(b"<")
+        if end == -1:
+            end = len(data)
+        self._tail = data[end:]
+        self._parse(data[:end])
+
+    def close(self) -> None:
+        """Parse any remaining buffered data."""
+        self._parse(self._tail)
+        self._tail = b""
+
+    def _parse(self, data: bytes) -> None:
+        """Parse container images from complete tags."""
+        self._images += [
+            (double or single).decode("ascii", "replace").replace("%3A", ":", 1)
+            for double, single in self._HREF_PATTERN.findall(data)
+        ]
+
+
+class PrefixMatcher:
+    """
+    Define a matcher for strings that start with any of the given prefixes.
 
-    @property
-    def images(self) -> List[str]:
-        """Return the list of parsed container images."""
-        return self._images.copy()
+    The prefixes are kept sorted, without those that extend a shorter prefix. All
+    strings starting with a prefix sort directly after it, so only the closest
+    prefix preceding a string needs to be compared, which is found by bisection.
 
-    def handle_starttag(self, tag: str, attrs: List[Tuple[str, str]]) -> None:
-        """Parse container images from a given tag and its attributes."""
-        if tag != "a":
-            return
-        for attr, value in attrs:
-            if attr != "href":
-                continue
-            if "%3A" in value:
-                self._images.append(value.replace("%3A", ":", 1))
+    """
+
+    def __init__(self, prefixes: Iterable[str]) -> None:
+        """Sort the given prefixes, dropping those covered by a shorter one."""
+        self._prefixes = []
+        for prefix in sorted(frozenset(prefixes)):
+            if not (self._prefixes and prefix.startswith(self._prefixes[-1])):
+                self._prefixes.append(prefix)
+
+    def matches(self, text: str) -> bool:
+        """Return whether the given text starts with any of the prefixes."""
+        index = bisect.bisect_right(self._prefixes, text) - 1
+        return index >= 0 and text.startswith(self._prefixes[index])
 
 
 class QuayImageFetcher:
@@ -98,8 +202,22 @@ class QuayImageFetcher:
         params: Optional[Dict[str, str]] = None,
         headers: Optional[Dict[str, str]] = None,
         log_file: Path = Path(".quay.log"),
-    ) -> List[str]:
-        """Fetch all container images and their tags."""
+        cache_file: Path = Path(".quay-cache.json"),
+        cache_max_days: float = 7,
+        max_concurrency: int = 64,
+        max_per_second: Optional[float] = 10,
+    ) -> Set[str]:
+        """
+        Fetch all container images and their tags.
+
+        Tags from a previous run are read from the cache file. Repositories whose
+        modification time in the repository list is unchanged, and whose tags were
+        confirmed within the last `cache_max_days`, are not requested at all; the
+        others are only re-downloaded if quay.io reports that they changed.
+        The cache is written even if fetching fails, so that it can fill up over
+        several runs.
+
+        """
         if headers is None:
             headers = {
                 "Accept-Encoding": "gzip",
@@ -107,36 +225,72 @@ class QuayImageFetcher:
                 "User-Agent": "singularity-build-bot",
             }
         if params is None:
-            params = {"public": "true", "repo_kind": "image"}
+            params = {"public": "true", "repo_kind": "image", "last_modified": "true"}
         params["namespace"] = repository
-        async with httpx.AsyncClient(
-            base_url=api_url, headers=headers, timeout=httpx.Timeout(12)
-        ) as client:
-            names = await cls._fetch_names(client=client, params=params)
-            images = await cls._fetch_tags(
-                client=client, repository=repository, names=names
-            )
-        log_images(log_file=log_file, images=images)
+        previous = RepositoryCache.load(cache_file)
+        cache = RepositoryCache()
+        images = set()
+
+        def collect(repo: CachedRepository) -> None:
+            """Add a fetched repository to the new cache and its images to the set."""
+            cache.repositories[repo.name] = repo
+            images.update([f"{repo.name}:{tag}" for tag in repo.tags])
+
+        try:
+            # Multiplex the many small tag requests over HTTP/2 and keep enough
+            # connections alive to serve the configured concurrency.
+            async with httpx.AsyncClient(
+                base_url=api_url,
+                headers=headers,
+                timeout=httpx.Timeout(12),
+                http2=True,
+                limits=httpx.Limits(
+                    max_connections=max_concurrency,
+                    max_keepalive_connections=max_concurrency,
+                ),
+            ) as client:
+                repositories = await cls._fetch_repositories(
+                    client=client, params=params
+                )
+                await cls._fetch_tags(
+                    client=client,
+                    repository=repository,
+                    repositories=repositories,
+                    cache=previous.repositories,
+                    collect=collect,
+                    cache_max_days=cache_max_days,
+                    max_concurrency=max_concurrency,
+                    max_per_second=max_per_second,
+                )
+        except BaseException:
+            # Keep the repositories fetched so far, and the previous entries of those
+            # that were not reached, for the next run.
+            RepositoryCache(
+                repositories={**previous.repositories, **cache.repositories}
+            ).dump(cache_file)
+            raise
+        cache.dump(cache_file)
+        log_images(log_file=log_file, images=sorted(images))
         return images
 
     @classmethod
-    async def _fetch_names(
+    async def _fetch_repositories(
         cls, client: httpx.AsyncClient, params: Dict[str, str]
-    ) -> List[str]:
+    ) -> List[Repository]:
         """Fetch one or more batches of container images."""
-        names = []
+        repositories = []
         with cls._progress_spinner() as pbar:
             task = pbar.add_task(description="Image Batch")
             repos = await cls._fetch_repository_list(client=client, params=params)
-            names.extend((repo.name for repo in repos.repositories))
+            repositories.extend(repos.repositories)
             pbar.update(task, advance=1)
             while repos.next_page:
                 repos = await cls._fetch_repository_list(
                     client=client, params={**params, "next_page": repos.next_page}
                 )
-                names.extend((repo.name for repo in repos.repositories))
+                repositories.extend(repos.repositories)
                 pbar.update(task, advance=1)
-        return names
+        return repositories
 
     @classmethod
     def _progress_spinner(cls) -> rprog.Progress:
@@ -163,41 +317,72 @@ class QuayImageFetcher:
         """Fetch a list of repositories and parse the response."""
         response = await client.get("repository", params=params)
         response.raise_for_status()
-        return RepositoryListResponse.parse_obj(response.json())
+        return REPOSITORY_LIST_DECODER.decode(response.content)
 
     @classmethod
     async def _fetch_tags(
         cls,
         client: httpx.AsyncClient,
         repository: str,
-        names: List[str],
-        max_concurrency: int = 10,
-        max_per_second: int = 10,
-    ) -> List[str]:
+        repositories: List[Repository],
+        cache: Dict[str, CachedRepository],
+        collect: Callable[[CachedRepository], None],
+        cache_max_days: float = 7,
+        max_concurrency: int = 64,
+        max_per_second: Optional[float] = 10,
+        progress_interval: int = 25,
+    ) -> None:
         """
         Fetch the image tags for each given container image.
 
-        Fetching is performed concurrently, in a resilient manner, observing the given
-        limits.
+        Each repository is passed to `collect` as soon as its tags are known. Cached
+        repositories that are unchanged and not yet expired are reused without a
+        request; the others are fetched concurrently, observing the given limits.
 
         """
-        requests = [
-            client.build_request(method="GET", url=f"repository/{repository}/{name}")
-            for name in names
-        ]
-        images = []
+        unchanged = []
+        timestamps = {}
+        now = time.time()
+        max_age = cache_max_days * 24 * 60 * 60
+        for repo in repositories:
+            cached = cache.get(repo.name)
+            if (
+                cached is not None
+                and repo.last_modified is not None
+                and cached.timestamp == repo.last_modified
+                and cached.fetched_at is not None
+                and now - cached.fetched_at < cls._max_age(repo.name, max_age)
+            ):
+                unchanged.append(cached)
+            else:
+                timestamps[repo.name] = repo.last_modified
+        logger.info(
+            f"Reusing cached tags of {len(unchanged):,} unchanged repositories."
+        )
+        for repo in unchanged:
+            collect(repo)
         with cls._progress_bar() as pbar:
-            task = pbar.add_task(description="Image Tags", total=len(requests))
+            task = pbar.add_task(description="Image Tags", total=len(timestamps))
             async with aiometer.amap(
-                partial(cls._fetch_single_repository, client),
-                requests,
+                partial(cls._fetch_single_repository, client, repository, cache),
+                timestamps,
                 max_at_once=max_concurrency,
                 max_per_second=max_per_second,
             ) as results:
-                async for repo in results:  # type: SingleRepositoryResponse
-                    images.extend((f"{repo.name}:{tag}" for tag in repo.tags))
-                    pbar.update(task, advance=1)
-        return images
+                done = 0
+                async for repo in results:  # type: CachedRepository
+                    repo.timestamp = timestamps.get(repo.name)
+                    collect(repo)
+                    done += 1
+                    if done % progress_interval == 0:
+                        pbar.update(task, completed=done)
+                pbar.update(task, completed=done)
+
+    @staticmethod
+    def _max_age(name: str, max_age: float) -> float:
+        """Return a stable share of the maximum age, between half and all of it."""
+        # Entries fetched in the same run would otherwise all expire in the same run.
+        return max_age * (0.5 + zlib.crc32(name.encode()) / 2**33)
 
     @classmethod
     def _progress_bar(cls) -> rprog.Progress:
@@ -210,6 +395,7 @@ class QuayImageFetcher:
             rprog.TimeRemainingColumn(),
             " ",
             rprog.TimeElapsedColumn(),
+            refresh_per_second=4,
         )
 
     @staticmethod
@@ -221,42 +407,68 @@ class QuayImageFetcher:
         before=tenacity.before_log(logger, logging.DEBUG),
     )
     async def _fetch_single_repository(
-        client: httpx.AsyncClient, request: httpx.Request
-    ) -> SingleRepositoryResponse:
-        """Fetch a single repository resource and parse the response."""
-        response = await client.send(request=request)
+        client: httpx.AsyncClient,
+        repository: str,
+        cache: Dict[str, CachedRepository],
+        name: str,
+    ) -> CachedRepository:
+        """
+        Fetch a single repository resource and parse the response.
+
+        If the repository is cached, the request is made conditional on its validators
+        and a `304 Not Modified` response returns the cached tags without a body.
+
+        """
+        headers = {}
+        if (cached := cache.get(name)) is not None:
+            if cached.etag:
+                headers["If-None-Match"] = cached.etag
+            if cached.last_modified:
+                headers["If-Modified-Since"] = cached.last_modified
+        response = await client.get(f"repository/{repository}/{name}", headers=headers)
+        if cached is not None and response.status_code == httpx.codes.NOT_MODIFIED:
+            cached.fetched_at = time.time()
+            return cached
         response.raise_for_status()
-        return SingleRepositoryResponse.parse_obj(response.json())
+        repo = SINGLE_REPOSITORY_DECODER.decode(response.content)
+        return CachedRepository(
+            name=name,
+            tags=list(repo.tags),
+            fetched_at=time.time(),
+            etag=response.headers.get("ETag"),
+            last_modified=response.headers.get("Last-Modified"),
+        )
 
 
 class SingularityImageFetcher:
     @classmethod
-    def fetch_all(
+    async def fetch_all(
         cls,
         urls: Iterable[str],
         headers: Optional[Dict[str, str]] = None,
         log_file: Path = Path(".singularity.log"),
-    ) -> List[str]:
-        """Parse container images from each given URL."""
+        max_concurrency: int = 8,
+    ) -> Set[str]:
+        """Parse container images from each given URL, fetching them concurrently."""
         if headers is None:
             headers = {
                 "Accept-Encoding": "gzip",
                 "Accept": "text/html",
                 "User-Agent": "singularity-build-bot",
             }
-        images = []
-        with httpx.Client(headers=headers) as client:
-            for url in urls:
-                parser = ContainerImageParser()
-                if response := cls._fetch_images(client=client, url=url):
-                    parser.feed(response)
-                    images.extend(parser.images)
-                else:
-                    logger.warning("No images found at '%s'.", url)
-        with log_file.open("w") as handle:
-            for img in images:
-                handle.write(f"{img}\n")
-        log_images(log_file=log_file, images=images)
+        urls = list(urls)
+        async with httpx.AsyncClient(headers=headers, http2=True) as client:
+            results = await aiometer.run_all(
+                [partial(cls._fetch_images, client, url) for url in urls],
+                max_at_once=max_concurrency,
+            )
+        images = set()
+        for url, parsed in zip(urls, results):
+            if parsed:
+                images.update(parsed)
+            else:
+                logger.warning("No images found at '%s'.", url)
+        log_images(log_file=log_file, images=sorted(images))
         return images
 
     @staticmethod
@@ -267,39 +479,63 @@ class SingularityImageFetcher:
         retry=tenacity.retry_if_exception_type(httpx.HTTPError),
         before=tenacity.before_log(logger, logging.DEBUG),
     )
-    def _fetch_images(client: httpx.Client, url: str) -> Optional[str]:
-        """Make a single GET request and return the response body as text."""
-        response = client.get(url=url)
-        response.raise_for_status()
-        return response.text
+    async def _fetch_images(
+        client: httpx.AsyncClient, url: str, chunk_size: int = 64 * 1024
+    ) -> List[str]:
+        """Stream a single GET request and parse container images as they arrive."""
+        parser = ContainerImageParser()
+        async with client.stream("GET", url) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes(chunk_size=chunk_size):
+                parser.feed(chunk)
+        parser.close()
+        return parser.drain()
+
+
+async def fetch_images(
+    quay_api: str,
+    quay_cache: Path,
+    quay_cache_max_days: float,
+    singularity_urls: Iterable[str],
+    max_concurrency: int,
+    max_per_second: Optional[float],
+) -> Tuple[Set[str], Set[str]]:
+    """Fetch quay.io and Singularity container images concurrently."""
+    return await asyncio.gather(
+        QuayImageFetcher.fetch_all(
+            api_url=quay_api,
+            cache_file=quay_cache,
+            cache_max_days=quay_cache_max_days,
+            max_concurrency=max_concurrency,
+            max_per_second=max_per_second,
+        ),
+        SingularityImageFetcher.fetch_all(urls=singularity_urls),
+    )
 
 
-def log_images(log_file: Path, images: List[str]) -> None:
-    with log_file.open("w") as handle:
-        for img in images:
-            handle.write(f"{img}\n")
+def log_images(log_file: Path, images: Iterable[str]) -> None:
+    """Write the given images to the log file in a single write, one per line."""
+    lines = "\n".join(images)
+    log_file.write_text(f"{lines}\n" if lines else "")
 
 
 def get_new_images(
-    quay_images: Iterable[str],
-    singularity_images: Iterable[str],
+    quay_images: AbstractSet[str],
+    singularity_images: AbstractSet[str],
     denylist: Iterable[str],
     log_file: Path = Path(".diff.log"),
 ) -> List[str]:
     """Identify new images from the given lists."""
-    denylist = tuple(denylist)
-    diff = sorted(frozenset(quay_images) - frozenset(singularity_images))
+    denied = PrefixMatcher(denylist)
+    diff = sorted(quay_images - singularity_images)
     log_images(log_file=log_file, images=diff)
-    # Filter new images using the deny list.
-    result = sorted(
-        filter(
-            lambda image: not any(image.startswith(entry) for entry in denylist),
-            diff,
-        )
-    )
+    # Filter new images using the deny list and move bioconductor images to the end
+    # in a single pass. Both keep the order of the already sorted difference.
     others = []
     bioconductor = []
-    for img in result:
+    for img in diff:
+        if denied.matches(img):
+            continue
         if img.startswith("bioconductor"):
             bioconductor.append(img)
         else:
@@ -315,9 +551,16 @@ def parse_denylist(filename: Path) -> List[str]:
 
 def generate_build_script(filename: Path, images: List[str]) -> None:
     """Generate a build script from provided templates."""
+    total = len(images)
     with filename.open("a") as handle:
-        for idx, img in enumerate(images, start=1):
-            handle.write(f"\nbuild_singularity_image {img} {idx} {len(images)}\n")
+        handle.write(
+            "".join(
+                [
+                    f"\nbuild_singularity_image {img} {idx} {total}\n"
+                    for idx, img in enumerate(images, start=1)
+                ]
+            )
+        )
 
 
 def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
@@ -352,6 +595,44 @@ def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
         help=f"The base URL for the quay.io API; must end with a '/' (default "
         f"'{default_quay_api}').",
     )
+    default_quay_cache = Path(".quay-cache.json")
+    parser.add_argument(
+        "--quay-cache",
+        metavar="PATH",
+        default=default_quay_cache,
+        type=Path,
+        help=f"File caching quay.io repository tags between runs (default "
+        f"'{default_quay_cache}').",
+    )
+    default_quay_cache_max_days = 7
+    parser.add_argument(
+        "--quay-cache-max-days",
+        metavar="DAYS",
+        type=float,
+        default=default_quay_cache_max_days,
+        help=f"Request cached repositories again after at most this many days, "
+        f"even if unchanged, to drop deleted tags (default "
+        f"{default_quay_cache_max_days}).",
+    )
+    default_max_concurrency = 64
+    parser.add_argument(
+        "--max-concurrency",
+        metavar="NUMBER",
+        type=int,
+        default=default_max_concurrency,
+        help=f"The maximum number of concurrent quay.io tag requests (default "
+        f"{default_max_concurrency}).",
+    )
+    default_max_per_second = 10
+    parser.add_argument(
+        "--max-per-second",
+        metavar="NUMBER",
+        type=float,
+        default=default_max_per_second,
+        help=f"The maximum number of quay.io tag requests started per second; "
+        f"rate limited requests are not retried for long (default "
+        f"{default_max_per_second}).",
+    )
     default_singularity_urls = "https://depot.galaxyproject.org/singularity/"
     parser.add_argument(
         "--singularity",
@@ -384,14 +665,23 @@ def main(argv: Optional[List[str]] = None) -> None:
     assert args.denylist.is_file(), f"File not found '{args.denylist}'."
     assert args.build_script.is_file(), f"File not found '{args.build_script}'."
     args.build_script.parent.mkdir(parents=True, exist_ok=True)
-    logger.info("Fetching quay.io BioContainers images.")
-    quay_images = asyncio.run(QuayImageFetcher.fetch_all(api_url=args.quay_api))
-    logger.info(f"Found {len(quay_images):,} images with tags.")
-    logger.info("Fetching Singularity BioContainers images.")
-    singularity_images = SingularityImageFetcher.fetch_all(
-        urls=args.singularity.split(",")
+    logger.info("Fetching quay.io and Singularity BioContainers images.")
+    # Exempt all objects created during start-up from the collections triggered by
+    # the allocations while fetching.
+    gc.freeze()
+    # uvloop reduces the event loop overhead of the many concurrent requests.
+    quay_images, singularity_images = uvloop.run(
+        fetch_images(
+            quay_api=args.quay_api,
+            quay_cache=args.quay_cache,
+            quay_cache_max_days=args.quay_cache_max_days,
+            singularity_urls=args.singularity.split(","),
+            max_concurrency=args.max_concurrency,
+            max_per_second=args.max_per_second,
+        )
     )
-    logger.info(f"Found {len(singularity_images):,} images with tags.")
+    logger.info(f"Found {len(quay_images):,} quay.io images with tags.")
+    logger.info(f"Found {len(singularity_images):,} Singularity images with tags.")
     logger.info("Parsing container image deny list.")
     denylist = parse_denylist(args.denylist)
     images = get_new_images(quay_images, singularity_images, denylist)
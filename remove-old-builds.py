@@ -10,37 +10,41 @@ import os
 import sys
 from collections import defaultdict
 
-image_dict = defaultdict(list)
+latest_builds = dict()
+old_builds = defaultdict(list)
 image_to_archive = list()
 
-for image in os.listdir(sys.argv[1]):
-    if '--' in image:
-        image_name, image_build_string = image.rsplit('--', 1)
-        if '_' in image_build_string:
-            try:
-                build_string, build_number = image_build_string.rsplit('_', 1)
-                image_dict[image_name].append( (build_string, int(build_number)) )
-            except:
-                # some wired image names, needs to be investigated
-                pass
-
-for k, v in image_dict.items():
-    if not v:
-        continue
-    # We want to have the latest build so we need to sort for the latest build-number.
-    # However, we can have the same build-number multiple-times with a different build-string.
-    # In this case we sort the build-string. This is a bit arbritrary, but should cover hopefully most cases. 
-    v.sort(key=lambda x: (x[1], x[0]))
-    # pop the latest element after sorting. The latest element should be the most recent build, all remaining
-    # images stay in the list and can be archived.
-    v.pop()
-    for build_string, build_number in v:
-        name = f'{k}--{build_string}_{build_number}'
-        if os.path.exists(name):
-            image_to_archive.append(name)
-            print(name)
+with os.scandir(sys.argv[1]) as entries:
+    for entry in entries:
+        image_name, separator, image_build_string = entry.name.rpartition('--')
+        if not separator:
+            continue
+        build_string, separator, build_number = image_build_string.rpartition('_')
+        if not separator:
+            continue
+        try:
+            # We want to keep the latest build, so we compare the build-number first.
+            # However, we can have the same build-number multiple-times with a different build-string.
+            # In this case we compare the build-string. This is a bit arbritrary, but should cover hopefully most cases.
+            build = (int(build_number), build_string, entry.name)
+        except ValueError:
+            # some wired image names, needs to be investigated
+            continue
+        # Only keep track of the most recent build in a single pass, all other builds can be archived.
+        latest = latest_builds.get(image_name)
+        if latest is None:
+            latest_builds[image_name] = build
+        elif build > latest:
+            old_builds[image_name].append(latest)
+            latest_builds[image_name] = build
         else:
-            sys.exit(f'image "{name}" does not exist')
+            old_builds[image_name].append(build)
+
+# The images were just listed from the directory, so they do not need to be checked for existence again.
+for builds in old_builds.values():
+    for build_number, build_string, name in builds:
+        image_to_archive.append(name)
+        print(name)
 
 #do something useful with "image_to_archive"
 